@@ -1,5 +1,9 @@
 import argparse
-import io
+import concurrent.futures
+import contextlib
+import filecmp
+import functools
+import hashlib
 import os
 import pathlib
 import re
@@ -10,25 +14,123 @@ import tempfile
 import typing
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import libarchive
+except ImportError:
+    libarchive = None
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
 
 IANA_LATEST_LOCATION = 'https://www.iana.org/time-zones/repository/tzdata-latest.tar.gz'
 SOURCE = 'https://data.iana.org/time-zones/releases'
 WORKING_DIR = pathlib.Path('tmp')
+LATEST_TARBALL_LOCATION = WORKING_DIR / 'tzdata-latest.tar.gz'
 REPO_ROOT = pathlib.Path(__file__).parent
 PKG_BASE = REPO_ROOT / 'src'
-DATA_TEMPLATE_FILE = """// This file is automatically generated
+# src/data.rs is written as this header, one line per zone and then the footer
+DATA_HEADER_TEMPLATE = """// This file is automatically generated
 // Please do not touch it.
 // The data in this file corresponds to the IANA database version {version}
 
 use crate::ZoneEntry;
 
 pub const MAPPINGS: [ZoneEntry; {length}] = [
-{data}
+"""
+DATA_FOOTER = """
 ];
 """
+# Downloads are streamed to disk in chunks of this size rather than buffered in memory
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# tarfile copies member data in 16 KiB chunks by default, which means a lot of
+# tiny read/inflate/write round trips through the gzip stream
+TAR_COPY_BUFSIZE = 2 * 1024 * 1024
+# Maps every byte value to its spelling inside a Rust byte string literal
+RUST_BYTE_ESCAPES = [chr(a) if 0x7F >= a >= 0x20 and a not in (0x22, 0x5C) else f'\\x{a:02x}' for a in range(256)]
 CARGO_TOML_VERSION = re.compile(r'^version = \"1\.(?P<version>\d{4,}\.\d+)\"', re.MULTILINE)
 
 
+def create_session() -> requests.Session:
+    """Creates the HTTP session used for every download.
+
+    Sharing a session keeps connections to the IANA servers alive between requests.
+    """
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+
+SESSION = create_session()
+
+
+def stream_to_file(url: str, location: pathlib.Path) -> None:
+    """Downloads the given URL to a file without buffering the whole response in memory."""
+    with SESSION.get(url, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        # Write to a temporary name so an interrupted download is never mistaken for a complete one
+        partial = location.with_name(location.name + '.part')
+        with open(partial, 'wb') as f:
+            shutil.copyfileobj(r.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+
+    os.replace(partial, location)
+
+
+def tarball_cache_dir(version: str) -> pathlib.Path:
+    """Returns the per-user directory where the tarballs for a version are cached."""
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    base = pathlib.Path(cache_home) if cache_home else pathlib.Path.home() / '.cache'
+    return base / 'eos-tzdata' / version
+
+
+def copy_atomically(source: pathlib.Path, destination: pathlib.Path) -> None:
+    """Copies a file so that ``destination`` is never seen partially written.
+
+    The copy is a separate file, so later writes to either side never affect the other.
+    """
+    partial = destination.with_name(destination.name + '.part')
+    shutil.copyfile(source, partial)
+    os.replace(partial, destination)
+
+
+def download_tzdb_tarball(
+    filename: str, target_dir: pathlib.Path, cache_dir: pathlib.Path, base_url: str = SOURCE
+) -> pathlib.Path:
+    """Download a single tzdb tarball into the target directory.
+
+    Released tarballs never change, so they are also kept in ``cache_dir`` and
+    reused from there by later runs with a fresh working directory.
+    """
+    download_location = target_dir / filename
+    cache_location = cache_dir / filename
+
+    if download_location.exists():
+        print(f'info: file {download_location} already exists, skipping')
+        return download_location
+
+    if cache_location.exists():
+        print(f'info: using cached {cache_location}')
+        copy_atomically(cache_location, download_location)
+        return download_location
+
+    url = f'{base_url}/{filename}'
+    print(f'info: downloading {filename} from {url}')
+    stream_to_file(url, download_location)
+
+    # Only files fetched from the release server go into the cache, anything already
+    # in the working directory may have come from --source-dir and been patched
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    copy_atomically(download_location, cache_location)
+    return download_location
+
+
 def download_tzdb_tarballs(
     version: str, base_url: str = SOURCE, working_dir: pathlib.Path = WORKING_DIR
 ) -> typing.List[pathlib.Path]:
@@ -39,24 +141,15 @@ def download_tzdb_tarballs(
     target_dir = working_dir / version / 'download'
     # mkdir -p target_dir
     target_dir.mkdir(parents=True, exist_ok=True)
+    cache_dir = tarball_cache_dir(version)
 
-    download_locations = []
-    for filename in [tzdata_file, tzcode_file]:
-        download_location = target_dir / filename
-        download_locations.append(download_location)
-
-        if download_location.exists():
-            print(f'info: file {download_location} already exists, skipping')
-            continue
-
-        url = f'{base_url}/{filename}'
-        print(f'info: downloading {filename} from {url}', filename, url)
-
-        r = requests.get(url)
-        with open(download_location, 'wb') as f:
-            f.write(r.content)
-
-    return download_locations
+    # The downloads are network bound so fetch both at the same time
+    filenames = [tzdata_file, tzcode_file]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(filenames)) as executor:
+        futures = [
+            executor.submit(download_tzdb_tarball, filename, target_dir, cache_dir, base_url) for filename in filenames
+        ]
+        return [future.result() for future in futures]
 
 
 def retrieve_local_tarballs(
@@ -82,6 +175,8 @@ def retrieve_local_tarballs(
 
         if dest_location.exists():
             print(f'info: file {dest_location} exists, overwriting')
+            # Unlink rather than write through it, in case it shares its inode with another file
+            dest_location.unlink()
 
         shutil.copy(source_location, dest_location)
 
@@ -90,6 +185,42 @@ def retrieve_local_tarballs(
     return dest_locations
 
 
+@contextlib.contextmanager
+def open_tarball(path: pathlib.Path, *, stream: bool = False) -> typing.Iterator[tarfile.TarFile]:
+    """Opens a gzipped tarball for reading.
+
+    If ``isal`` is installed, decompression goes through ISA-L instead of zlib.
+    """
+    if igzip is None:
+        with tarfile.open(path, mode='r|gz' if stream else 'r:gz', copybufsize=TAR_COPY_BUFSIZE) as tf:
+            yield tf
+    else:
+        with igzip.IGzipFile(path, 'rb') as fobj:
+            with tarfile.open(fileobj=fobj, mode='r|' if stream else 'r:', copybufsize=TAR_COPY_BUFSIZE) as tf:
+                yield tf
+
+
+def extract_tarball(tarball: pathlib.Path, target_dir: pathlib.Path) -> None:
+    """Extracts a gzipped tarball into the target directory.
+
+    Native extractors are preferred over tarfile's pure-Python member loop:
+    the system tar if there is one, then libarchive if ``libarchive-c`` is installed.
+    """
+    if shutil.which('tar') is not None:
+        subprocess.run(['tar', '-xzf', os.fspath(tarball.absolute()), '-C', os.fspath(target_dir)], check=True)
+    elif libarchive is not None:
+        # libarchive always extracts relative to the current working directory
+        cwd = os.getcwd()
+        os.chdir(target_dir)
+        try:
+            libarchive.extract_file(os.fspath(tarball.absolute()))
+        finally:
+            os.chdir(cwd)
+    else:
+        with open_tarball(tarball.absolute()) as fp:
+            fp.extractall(target_dir)
+
+
 def unpack_tzdb_tarballs(download_locations: typing.List[pathlib.Path]) -> pathlib.Path:
     assert len(download_locations) == 2
     assert download_locations[0].parent == download_locations[1].parent
@@ -104,12 +235,23 @@ def unpack_tzdb_tarballs(download_locations: typing.List[pathlib.Path]) -> pathl
 
     for tarball in download_locations:
         print(f'info: unpacking {tarball} to {target_dir}')
-        with tarfile.open(tarball.absolute(), mode='r:gz') as fp:
-            fp.extractall(target_dir)
+        extract_tarball(tarball, target_dir)
 
     return target_dir
 
 
+def make_commands(destdir: str, jobs: int) -> typing.List[typing.List[str]]:
+    """Returns the make invocations that build the zoneinfo files, in order.
+
+    The first installs the zoneinfo files under ``destdir`` using ``jobs`` parallel jobs,
+    the second prints the zone names.
+    """
+    return [
+        ['make', '-j', str(jobs), f'DESTDIR={destdir}', 'POSIXRULES=-', 'ZFLAGS=-b slim', 'install'],
+        ['make', 'zonenames'],
+    ]
+
+
 def load_zonefiles(
     base_dir: pathlib.Path,
 ) -> typing.Tuple[typing.List[str], pathlib.Path]:
@@ -117,42 +259,111 @@ def load_zonefiles(
     if target_dir.exists():
         shutil.rmtree(target_dir)
 
-    with tempfile.TemporaryDirectory() as td:
+    # Install next to the target directory so that moving the zoneinfo files
+    # into place is a rename rather than a copy across filesystems.
+    # It has to be absolute since make runs from inside base_dir.
+    with tempfile.TemporaryDirectory(dir=base_dir.parent.absolute()) as td:
         td_path = pathlib.Path(td)
 
+        install_command, zonenames_command = make_commands(td, os.cpu_count() or 4)
+
         # First run the makefile, which does all kinds of other random stuff
-        subprocess.run(
-            ['make', f'DESTDIR={td}', 'POSIXRULES=-', 'ZFLAGS=-b slim', 'install'],
-            cwd=base_dir,
-            check=True,
-        )
+        subprocess.run(install_command, cwd=base_dir, check=True)
 
-        proc = subprocess.run(['make', 'zonenames'], cwd=base_dir, stdout=subprocess.PIPE, check=True)
+        proc = subprocess.run(zonenames_command, cwd=base_dir, stdout=subprocess.PIPE, check=True)
         zonenames = list(map(str.strip, proc.stdout.decode('utf-8').split('\n')))
 
         # Move the zoneinfo files into the target directory
         src_dir = td_path / 'usr' / 'share' / 'zoneinfo'
-        shutil.move(os.fspath(src_dir), os.fspath(target_dir))
+        os.rename(src_dir, target_dir)
 
     return zonenames, target_dir
 
 
-def is_already_latest_version(version: str) -> bool:
-    """Returns ``True`` if the version is already the latest version"""
+def list_zonefiles(zoneinfo_dir: pathlib.Path) -> typing.Set[str]:
+    """Returns the paths of every file under the zoneinfo directory, relative to it"""
+    files = set()
+    for root, _, names in os.walk(zoneinfo_dir):
+        rel = pathlib.Path(root).relative_to(zoneinfo_dir)
+        files.update((rel / name).as_posix() for name in names)
+    return files
+
+
+def build_digest(download_locations: typing.List[pathlib.Path]) -> str:
+    """Returns a SHA-256 hex digest covering the given tarballs and the make commands run on them"""
+    digest = hashlib.sha256()
+    for tarball in download_locations:
+        with open(tarball, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(DOWNLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+    # DESTDIR is a fresh temporary directory every time and the job count depends on the
+    # machine, neither of which changes the installed files, so both are pinned here
+    for command in make_commands('', 1):
+        digest.update('\0'.join(command).encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+
+def build_zonefiles(
+    download_locations: typing.List[pathlib.Path],
+) -> typing.Tuple[typing.List[str], pathlib.Path]:
+    """Unpacks the tarballs and builds the zoneinfo files from them.
+
+    A successful build leaves a stamp with the digest of the tarballs and make commands it was built with,
+    so later runs with the same inputs reuse the zoneinfo files instead of running make again.
+    """
+    base_dir = download_locations[0].parent.parent
+    stamp_location = base_dir / '.built'
+    zonenames_location = base_dir / 'zonenames.txt'
+    zoneinfo_dir = base_dir / 'zoneinfo'
+    digest = build_digest(download_locations)
+
+    try:
+        stamp = stamp_location.read_text()
+    except FileNotFoundError:
+        stamp = None
+
+    if stamp == digest and zoneinfo_dir.is_dir():
+        print(f'info: {zoneinfo_dir} is already built from these tarballs and settings, skipping')
+        return zonenames_location.read_text().splitlines(), zoneinfo_dir
+
+    # Invalidate the previous build before any of its files are touched
+    stamp_location.unlink(missing_ok=True)
+
+    tzdb_location = unpack_tzdb_tarballs(download_locations)
+    zonenames, zoneinfo_dir = load_zonefiles(tzdb_location)
+
+    zonenames_location.write_text('\n'.join(zonenames))
+    stamp_location.write_text(digest)
+    return zonenames, zoneinfo_dir
+
+
+@functools.lru_cache(maxsize=None)
+def current_package_version() -> typing.Optional[typing.Tuple[int, ...]]:
+    """Returns the parsed package version from the VERSION file, if any"""
     try:
         with open('VERSION', 'r') as fp:
             other = fp.read().strip()
     except OSError:
-        return False
+        return None
     else:
-        lhs = tuple(map(int, version.split('.')))
-        rhs = tuple(map(int, other.split('.')))
-        return lhs <= rhs
+        return tuple(map(int, other.split('.')))
+
+
+def is_already_latest_version(version: str) -> bool:
+    """Returns ``True`` if the version is already the latest version"""
+    rhs = current_package_version()
+    if rhs is None:
+        return False
+
+    lhs = tuple(map(int, version.split('.')))
+    return lhs <= rhs
 
 
 def python_bytes_to_rust(b: bytes) -> str:
     # turn b'1\x9f10' to the Rust version with double quotes
-    inner = ''.join(chr(a) if 0x7F >= a >= 0x20 and a not in (0x22, 0x5C) else f'\\x{a:02x}' for a in b)
+    # A list rather than a generator lets join size the result up front
+    inner = ''.join([RUST_BYTE_ESCAPES[a] for a in b])
     return f'b"{inner}"'
 
 
@@ -161,6 +372,39 @@ def convert_to_rust_struct(name: str, tzif: bytes) -> str:
     return f'    ZoneEntry {{ zone: "{name}", data: {python_bytes_to_rust(tzif)} }},\n'
 
 
+def replace_if_changed(source: pathlib.Path, destination: pathlib.Path) -> bool:
+    """Moves ``source`` over ``destination`` unless their contents are identical.
+
+    Leaving an identical file alone keeps its mtime, so cargo does not rebuild for nothing.
+    ``source`` is removed either way. Returns ``True`` if ``destination`` was replaced.
+    """
+    if destination.exists() and filecmp.cmp(source, destination, shallow=False):
+        source.unlink()
+        print(f'info: {destination} is unchanged, skipping')
+        return False
+
+    os.replace(source, destination)
+    return True
+
+
+def write_if_changed(location: pathlib.Path, contents: str) -> bool:
+    """Writes ``contents`` to ``location`` unless it already holds exactly that.
+
+    Returns ``True`` if the file was written.
+    """
+    try:
+        with open(location, 'r', encoding='utf-8', newline='\n') as fp:
+            if fp.read() == contents:
+                print(f'info: {location} is unchanged, skipping')
+                return False
+    except FileNotFoundError:
+        pass
+
+    with open(location, 'w', encoding='utf-8', newline='\n') as fp:
+        fp.write(contents)
+    return True
+
+
 def update_package(version: str, zonenames: typing.List[str], zoneinfo_dir: pathlib.Path):
     """Creates the tzdata package."""
     package_version = translate_version(version)
@@ -169,60 +413,85 @@ def update_package(version: str, zonenames: typing.List[str], zoneinfo_dir: path
         return
 
     # Sort the zone names by lexicographical position
-    zonenames = sorted(zonenames)
-
-    # fmt: off
-    # Generate a compile mapping of zone name -> byte data
-    zone_to_bytes = {
-        name: open(zoneinfo_dir / name, 'rb').read()
-        for name in zonenames
-        if (zoneinfo_dir / name).is_file()
-    }
-
-    # Convert the mapping into a Rust struct literal
-    data = [
-        convert_to_rust_struct(name, tzif)
-        for name, tzif in zone_to_bytes.items()
-    ]
-    # fmt: on
+    # A single directory walk is cheaper than a stat call per zone name
+    zonefiles = list_zonefiles(zoneinfo_dir)
+    zonenames = sorted(name for name in zonenames if name in zonefiles)
+
+    def read_zonefile(name: str) -> bytes:
+        return (zoneinfo_dir / name).read_bytes()
 
     # Create the actual src/data.rs
-    with open(PKG_BASE / 'data.rs', 'w', encoding='utf-8', newline='\n') as fp:
-        length = len(data)
-        fp.write(DATA_TEMPLATE_FILE.format(length=length, version=version, data=''.join(data)))
+    # Each zone is written out as soon as it is converted rather than building the whole file in memory.
+    # These are hundreds of tiny files so reading them is dominated by syscall latency, hence the thread pool.
+    # It is written to a temporary file first so that an unchanged data.rs can be left alone.
+    data_location = PKG_BASE / 'data.rs'
+    data_tmp_location = data_location.with_name('data.rs.tmp')
+    with open(data_tmp_location, 'w', encoding='utf-8', newline='\n') as fp:
+        fp.write(DATA_HEADER_TEMPLATE.format(length=len(zonenames), version=version))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            tzifs = executor.map(read_zonefile, zonenames)
+            fp.writelines(convert_to_rust_struct(name, tzif) for name, tzif in zip(zonenames, tzifs))
+        fp.write(DATA_FOOTER)
+
+    replace_if_changed(data_tmp_location, data_location)
 
     # Write the actual VERSION
-    with open(REPO_ROOT / 'VERSION', 'w') as f:
-        f.write(package_version)
+    write_if_changed(REPO_ROOT / 'VERSION', package_version)
 
     # Update the Cargo.toml version
-    with open(REPO_ROOT / 'Cargo.toml', 'r+', encoding='utf-8', newline='\n') as fp:
+    cargo_toml_location = REPO_ROOT / 'Cargo.toml'
+    with open(cargo_toml_location, 'r', encoding='utf-8', newline='\n') as fp:
         contents = fp.read()
-        updated = CARGO_TOML_VERSION.sub(f'version = "1.{package_version}"', contents, count=1)
-        fp.seek(0)
-        fp.write(updated)
-        fp.truncate()
+
+    match = CARGO_TOML_VERSION.search(contents)
+    assert match is not None, 'could not find the version in Cargo.toml'
+    updated = f'{contents[:match.start()]}version = "1.{package_version}"{contents[match.end():]}'
+    write_if_changed(cargo_toml_location, updated)
 
 
 def find_latest_version() -> str:
-    r = requests.get(IANA_LATEST_LOCATION)
-    fobj = io.BytesIO(r.content)
-    with tarfile.open(fileobj=fobj, mode='r:gz') as tf:
-        vfile = tf.extractfile('version')
+    """Downloads the latest tzdata tarball and returns the version it contains.
 
-        assert vfile is not None, 'version file is not a regular file'
-        version = vfile.read().decode('utf-8').strip()
+    The tarball is left in the working directory, see :func:`cache_latest_tarball`.
+    """
+    WORKING_DIR.mkdir(parents=True, exist_ok=True)
+    stream_to_file(IANA_LATEST_LOCATION, LATEST_TARBALL_LOCATION)
+
+    # Looking the member up by name would index (and so decompress) the whole archive first,
+    # so scan forward in stream mode and stop as soon as the version file turns up
+    version = None
+    with open_tarball(LATEST_TARBALL_LOCATION, stream=True) as tf:
+        for member in tf:
+            if member.name == 'version':
+                vfile = tf.extractfile(member)
+
+                assert vfile is not None, 'version file is not a regular file'
+                version = vfile.read().decode('utf-8').strip()
+                break
+
+    assert version is not None, 'version file not found in the latest tarball'
 
     assert re.match(r'\d{4}[a-z]$', version), version
+    return version
+
+
+def cache_latest_tarball(version: str) -> None:
+    """Moves the tarball fetched by :func:`find_latest_version` to where :func:`download_tzdb_tarballs` expects it.
 
+    It came straight from IANA, so it is also added to the per-version tarball cache.
+    """
+    filename = f'tzdata{version}.tar.gz'
     target_dir = WORKING_DIR / version / 'download'
     target_dir.mkdir(parents=True, exist_ok=True)
 
-    fobj.seek(0)
-    with open(target_dir / f'tzdata{version}.tar.gz', 'wb') as f:
-        f.write(fobj.read())
+    download_location = target_dir / filename
+    os.replace(LATEST_TARBALL_LOCATION, download_location)
 
-    return version
+    cache_dir = tarball_cache_dir(version)
+    cache_location = cache_dir / filename
+    if not cache_location.exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        copy_atomically(download_location, cache_location)
 
 
 def translate_version(iana_version: str) -> str:
@@ -273,13 +542,23 @@ def main():
             parser.error('--source-dir specified without --version.\nIf using --source-dir, --version must also be used.')
         download_locations = retrieve_local_tarballs(args.version, args.source_dir)
     else:
-        if args.version is None:
+        from_latest = args.version is None
+        if from_latest:
             args.version = find_latest_version()
 
+        # Bail out before the downloads and the build, which is where all the time goes
+        if is_already_latest_version(translate_version(args.version)):
+            print(f'info: {args.version} is already the newest TZDB version, no work to do.')
+            if from_latest:
+                LATEST_TARBALL_LOCATION.unlink(missing_ok=True)
+            return
+
+        if from_latest:
+            cache_latest_tarball(args.version)
+
         download_locations = download_tzdb_tarballs(args.version)
 
-    tzdb_location = unpack_tzdb_tarballs(download_locations)
-    zonenames, zonefile_path = load_zonefiles(tzdb_location)
+    zonenames, zonefile_path = build_zonefiles(download_locations)
     update_package(args.version, zonenames, zonefile_path)
 
 